@@ -1,14 +1,23 @@
-from fastapi import APIRouter, Body
-from fastapi import Body
-import os
-import json
+from fastapi import APIRouter, Body, HTTPException, Request
+from fastapi.responses import Response
+import orjson
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime
 import hashlib
+import bisect
+import secrets
+
+from .logging_config import get_logger
+from .openai_client import get_openai_client
+
+log = get_logger("llm")
 
 # Global state for tracking email diffs and user preferences
 email_diffs_store: Dict[str, Dict[str, Any]] = {}  # recipient_hash -> diff_data
+email_diff_keys: List[str] = []  # Sorted recipient hashes, the stable order /api/email-diffs pages through
+email_diffs_version = 0  # Bumped on every stored analysis; with the per-process tag below it forms the diffs ETag
+_EMAIL_DIFFS_ETAG_TAG = secrets.token_hex(4)  # Keeps ETags from matching across restarts or workers
 generated_emails_store: Dict[str, Dict[str, Any]] = {}  # email_id -> generated_content
 
 def get_recipient_hash(recipient: str) -> str:
@@ -24,14 +33,13 @@ def store_generated_email(email_id: str, generated_content: Dict[str, Any]):
 
 async def analyze_email_diffs(recipient: str, generated_content: Dict[str, Any], final_content: Dict[str, Any]) -> Dict[str, Any]:
     """Analyze differences between generated and final email content using LLM"""
+    global email_diffs_version
     recipient_hash = get_recipient_hash(recipient)
     
     # Use LLM to analyze differences
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if api_key and OpenAI is not None:
-            client = OpenAI(api_key=api_key)
-            
+        client = get_openai_client()
+        if client is not None:
             system_prompt = """You are an expert at analyzing email writing preferences. 
             Compare the original AI-generated email with the user's final edited version.
             Identify the key differences and return a concise analysis of the user's writing preferences.
@@ -50,7 +58,7 @@ Body: {final_content.get('body', '')}
 
 What are the key differences that reveal this user's writing preferences? Focus on style, tone, structure, and formatting."""
 
-            completion = client.chat.completions.create(
+            completion = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -65,7 +73,7 @@ What are the key differences that reveal this user's writing preferences? Focus
             # Fallback to simple analysis if LLM not available
             llm_analysis = "LLM analysis not available - using fallback"
     except Exception as e:
-        print(f"LLM analysis failed: {e}")
+        log.warning("LLM analysis failed: %s", e)
         llm_analysis = "LLM analysis failed - using fallback"
     
     diff_analysis = {
@@ -82,8 +90,10 @@ What are the key differences that reveal this user's writing preferences? Focus
             "analyses": [],
             "preferences": set()
         }
+        bisect.insort(email_diff_keys, recipient_hash)
     
     email_diffs_store[recipient_hash]["analyses"].append(diff_analysis)
+    email_diffs_version += 1
     
     # Extract key preferences from LLM analysis for future use
     if "bullet points" in llm_analysis.lower():
@@ -119,14 +129,14 @@ def get_user_preferences(recipient: str) -> List[str]:
     return []
 
 try:
-    from openai import OpenAI
+    from dotenv import load_dotenv
 except Exception:
-    OpenAI = None  # Library may not be installed yet; handled at runtime
+    load_dotenv = None  # Optional; if missing, we simply skip explicit loading
 
 try:
-    from dotenv import load_dotenv
+    import msgpack
 except Exception:
-    load_dotenv = None  # Optional; if missing, we simply skip explicit loading
+    msgpack = None  # Optional; without it /api/email-diffs only serves JSON
 
 router = APIRouter()
 
@@ -171,13 +181,12 @@ def _fallback_generate_email(
 
 
 async def _generate_email_with_openai(payload):
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key or OpenAI is None:
+    client = get_openai_client()
+    if client is None:
         return _fallback_generate_email(
             payload.get("bullets", []), payload.get("tone", "neutral"), payload.get("recipient"), payload.get("subject")
         )
 
-    client = OpenAI(api_key=api_key)
     
     # Get learned preferences for this recipient
     recipient = payload.get("recipient", "")
@@ -213,18 +222,18 @@ async def _generate_email_with_openai(payload):
         user_instructions["learned_preferences"] = learned_preferences
 
     try:
-        print("MESSAGE INPUT", user_instructions)
-        completion = client.chat.completions.create(
+        log.debug("MESSAGE INPUT %s", user_instructions)
+        completion = await client.chat.completions.create(
             model="gpt-4o-mini",
             response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(user_instructions)},
+                {"role": "user", "content": orjson.dumps(user_instructions).decode()},
             ],
             temperature=0.7,
         )
         content = completion.choices[0].message.content
-        data = json.loads(content)
+        data = orjson.loads(content)
         subject = data.get("subject") or (
             payload.get("subject") or (payload.get("bullets", [])[0] if payload.get("bullets") else "")
         )
@@ -258,14 +267,21 @@ async def store_generated_email_endpoint(request: dict = Body(...)):
 
 @router.post("/api/analyze-email-diff")
 async def analyze_email_diff_endpoint(request: dict = Body(...)):
-    """Analyze differences between generated and final email content"""
+    """Analyze differences between generated and final email content.
+    
+    Clients send the email_id from store-generated-email and the server uses its stored
+    copy; an inline generated_content is still accepted when there is no stored copy.
+    """
     recipient = request.get("recipient")
-    generated_content = request.get("generated_content")
+    stored = generated_emails_store.get(request.get("email_id"))
+    generated_content = stored["generated"] if stored is not None else request.get("generated_content")
+    if generated_content is None:
+        raise HTTPException(status_code=404, detail="Email not found")
     final_content = request.get("final_content")
-    print("ai generated email", generated_content)
-    print("final email", final_content)
+    log.debug("ai generated email %s", generated_content)
+    log.debug("final email %s", final_content)
     analysis = await analyze_email_diffs(recipient, generated_content, final_content)
-    print("ANALYSIS", analysis)
+    log.debug("ANALYSIS %s", analysis)
     return analysis
 
 @router.get("/api/user-preferences/{recipient}")
@@ -286,7 +302,34 @@ async def get_stored_email_endpoint(email_id: str):
     else:
         return {"error": "Email not found"}, 404
 
+EMAIL_DIFFS_PAGE_MAX = 1000
+
+def _email_diffs_page(cursor: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """Build one page of stored email diffs, ordered by recipient hash"""
+    limit = max(1, min(limit, EMAIL_DIFFS_PAGE_MAX))
+    start = bisect.bisect_right(email_diff_keys, cursor) if cursor else 0
+    page_keys = email_diff_keys[start:start + limit]
+    items = [{"recipient_hash": key, **email_diffs_store[key]} for key in page_keys]
+    next_cursor = page_keys[-1] if start + limit < len(email_diff_keys) else None
+    return {"items": items, "next": next_cursor}
+
 @router.get("/api/email-diffs")
-async def get_all_email_diffs():
-    """Get all stored email diff data (for debugging/admin)"""
-    return email_diffs_store 
\ No newline at end of file
+async def get_all_email_diffs(request: Request, response: Response, cursor: Optional[str] = None, limit: int = 100):
+    """Get stored email diff data a page at a time (for debugging/admin).
+    
+    Pages are ordered by recipient hash; pass the returned "next" as cursor until it is null.
+    Clients sending Accept: application/msgpack get the page msgpack-encoded. Pages carry an
+    ETag that changes with any stored analysis; a matching If-None-Match gets a bodiless 304.
+    """
+    use_msgpack = msgpack is not None and "application/msgpack" in request.headers.get("accept", "")
+    etag = f'"{_EMAIL_DIFFS_ETAG_TAG}-{email_diffs_version}-{"msgpack" if use_msgpack else "json"}"'
+    headers = {"ETag": etag, "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    page = _email_diffs_page(cursor, limit)
+    if use_msgpack:
+        # Preferences are kept as sets; encode them as arrays
+        return Response(msgpack.packb(page, default=list), media_type="application/msgpack", headers=headers)
+    response.headers.update(headers)
+    return page
@@ -0,0 +1,33 @@
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+def _configure_logging() -> logging.Logger:
+    """Route "fmail" logs through a queue so request handlers never block on stdout"""
+    logger = logging.getLogger("fmail")
+    if logger.handlers:  # Already configured (e.g. module re-import under reload)
+        return logger
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    return logger
+
+
+_configure_logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Get a child of the queued "fmail" logger"""
+    return logging.getLogger(f"fmail.{name}")
@@ -1,15 +1,27 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
 import os
-import json
+import mmap
+import orjson
+
+# Skip OpenAPI schema generation and the docs UIs in production
+is_prod = os.getenv("ENV") == "prod"
 
 app = FastAPI(
     title="FMail Backend API",
     description="FastAPI backend for FMail application",
-    version="1.0.0"
+    version="1.0.0",
+    openapi_url=None if is_prod else "/openapi.json",
+    docs_url=None if is_prod else "/docs",
+    redoc_url=None if is_prod else "/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -21,6 +33,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large JSON payloads (Hillary emails, message lists)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Pydantic models
 class Message(BaseModel):
     id: Optional[int] = None
@@ -42,6 +57,12 @@ users_db: List[User] = []
 message_counter = 0
 user_counter = 0
 
+@lru_cache(maxsize=4)
+def _load_json_file(path: str, mtime_ns: int):
+    """Parse a JSON file straight from a read-only memory map; cached until the file changes"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        return orjson.loads(view)
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -137,10 +158,9 @@ async def get_hillary_emails():
         if not os.path.exists(hillary_emails_path):
             raise HTTPException(status_code=404, detail="Hillary emails file not found")
         
-        with open(hillary_emails_path, 'r', encoding='utf-8') as f:
-            hillary_emails = json.load(f)
+        hillary_emails = _load_json_file(hillary_emails_path, os.stat(hillary_emails_path).st_mtime_ns)
         
-        return hillary_emails
+        return ORJSONResponse(hillary_emails)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading Hillary emails: {str(e)}")
 
@@ -156,10 +176,11 @@ async def get_hillary_received_emails():
         if not os.path.exists(hillary_received_emails_path):
             raise HTTPException(status_code=404, detail="Hillary received emails file not found")
         
-        with open(hillary_received_emails_path, 'r', encoding='utf-8') as f:
-            hillary_received_emails = json.load(f)
+        hillary_received_emails = _load_json_file(
+            hillary_received_emails_path, os.stat(hillary_received_emails_path).st_mtime_ns
+        )
         
-        return hillary_received_emails
+        return ORJSONResponse(hillary_received_emails)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading Hillary received emails: {str(e)}")
 
@@ -175,7 +196,8 @@ app.include_router(workflow_router)
 @app.get("/api/stats")
 async def get_stats():
     """Get application statistics"""
-    unread_count = sum(1 for msg in messages_db if not msg.read)
+    # map/attrgetter iterate in C; bools sum as ints
+    unread_count = len(messages_db) - sum(map(attrgetter('read'), messages_db))
     return {
         "total_messages": len(messages_db),
         "unread_messages": unread_count,
@@ -185,4 +207,16 @@ async def get_stats():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("api.main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")), reload=True)
\ No newline at end of file
+    dev = os.getenv("DEV") == "1"
+    uvicorn.run(
+        "api.main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        # "auto" picks uvloop/httptools when installed and falls back to asyncio/h11 (e.g. on Windows)
+        loop="auto",
+        http="auto",
+        # Each worker keeps its own in-memory stores (sessions, suggestions, hooks, generated
+        # emails), so only raise WEB_CONCURRENCY when clients are pinned to one worker
+        workers=1 if dev else int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=dev,
+    )
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+from typing import Optional
+
+try:
+    from openai import AsyncOpenAI
+except Exception:
+    AsyncOpenAI = None  # Library may not be installed yet; handled at runtime
+
+_client: Optional["AsyncOpenAI"] = None
+
+
+def get_openai_client() -> Optional["AsyncOpenAI"]:
+    """Return the shared async OpenAI client, or None if the SDK or OPENAI_API_KEY is missing.
+
+    Reusing one client keeps its HTTP connection pool (and TLS sessions) alive across calls,
+    and awaiting it keeps LLM round trips from blocking the event loop.
+    """
+    global _client
+    if _client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key or AsyncOpenAI is None:
+            return None
+        _client = AsyncOpenAI(api_key=api_key)
+    return _client
@@ -1,26 +1,41 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, Set, Callable
+from fastapi import APIRouter, Body, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Optional, Set, Tuple, Callable, Literal, Final
 from datetime import datetime
 from enum import Enum
-import json
-import uuid
-import os
+from functools import lru_cache
+from collections import Counter, OrderedDict, deque
+import orjson
+import re
+import itertools
+import hashlib
+import math
+import operator
 import asyncio
+import ast
 import inspect
+import logging
+import time
+import secrets
 from pathlib import Path
 
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+from .logging_config import get_logger
+from .openai_client import get_openai_client
+from . import llm_api
 
 try:
     from dotenv import load_dotenv
 except Exception:
     load_dotenv = None
 
-router = APIRouter()
+try:
+    import msgpack
+except Exception:
+    msgpack = None  # Optional; without it only the JSON text protocol is offered
+
+router = APIRouter(prefix="/api/workflow")
+log = get_logger("workflow")
 
 # Load environment variables
 def _load_env_local() -> None:
@@ -70,23 +85,222 @@ class WorkflowSuggestion(BaseModel):
     reasoning: str
     generated_function: str
     trigger_event: str
-    created_at: datetime
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat())  # Pre-encoded for cheap serialization
 
 class SuggestionResponse(BaseModel):
     accepted: bool
     suggestion_id: str
 
+class SuggestionOut(BaseModel):
+    """Structured output schema for LLM pattern analysis"""
+    should_suggest: bool  # true only if a strong pattern exists and no similar workflow does
+    description: str  # short user-facing question, e.g. "Auto-archive newsletters from this sender?"
+    confidence: float  # 0-1
+    reasoning: str
+    hook_function: str  # JavaScript code block, no function wrapper
+    pattern_type: Literal["sender_based", "subject_based", "content_based", "time_based", "sequential", "location_based"]
+    trigger_event: Literal["email_received", "email_closed", "user_action"]
+
 # In-memory storage for hackathon
-action_logs: Dict[str, List[UserAction]] = {}  # user_id -> actions
+MAX_ACTIONS_PER_USER = 100  # Keep only recent actions per user for memory efficiency
+action_logs: Dict[str, deque] = {}  # user_id -> deque of raw action dicts shaped like UserAction
+PATTERN_HISTORY_WINDOW = 20  # Recent actions summarized in the LLM prompt
+action_pattern_window: Dict[str, deque] = {}  # user_id -> (action, sender, location) keys of recent actions
+action_pattern_counts: Dict[str, Counter] = {}  # user_id -> counts of the keys currently in the window
 hook_functions: Dict[str, List[Dict]] = {}  # user_id -> hooks
-suggestions_cache: Dict[str, WorkflowSuggestion] = {}  # suggestion_id -> suggestion
+rejected_suggestions: Dict[str, Set[str]] = {}  # user_id -> generated_function of suggestions the user declined
+hooks_by_trigger: Dict[str, Dict[str, List[Dict]]] = {}  # user_id -> trigger_event -> enabled hooks, in hook order
+
+# Running totals for /stats, updated wherever the stores above change
+_total_actions = 0
+_total_hooks = 0
+_total_executions = 0  # Sum of execution_count over current hooks
+
+class PendingSuggestions:
+    """Suggestions awaiting a user response, bounded by count and age.
+    
+    Clients that ignore or never answer a suggestion would otherwise leak entries.
+    Entries are kept in insertion order, so the oldest is always evicted first.
+    """
+    
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, str, WorkflowSuggestion]]" = OrderedDict()
+        self._by_code: Dict[Tuple[str, str], str] = {}  # (user_id, generated_function) -> suggestion_id
+    
+    def _forget(self, suggestion_id: str, entry: Tuple[float, str, WorkflowSuggestion]) -> None:
+        code_key = (entry[1], entry[2].generated_function)
+        if self._by_code.get(code_key) == suggestion_id:
+            del self._by_code[code_key]
+    
+    def _evict_oldest(self) -> None:
+        self._forget(*self._entries.popitem(last=False))
+    
+    def _evict_expired(self) -> None:
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            stored_at = next(iter(self._entries.values()))[0]
+            if stored_at >= cutoff:
+                break
+            self._evict_oldest()
+    
+    def add(self, user_id: str, suggestion: WorkflowSuggestion) -> None:
+        """Hold a suggestion made for user_id until that user answers it"""
+        self._entries[suggestion.id] = (time.monotonic(), user_id, suggestion)
+        self._entries.move_to_end(suggestion.id)
+        self._by_code[(user_id, suggestion.generated_function)] = suggestion.id
+        self._evict_expired()
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+    
+    def has_pending(self, user_id: str, generated_function: str) -> bool:
+        """Whether the user already has an unanswered suggestion with this code"""
+        self._evict_expired()
+        return (user_id, generated_function) in self._by_code
+    
+    def pop(self, user_id: str, suggestion_id: str) -> Optional[WorkflowSuggestion]:
+        """Remove and return the user's suggestion, or None if unknown, expired or made for someone else"""
+        self._evict_expired()
+        entry = self._entries.get(suggestion_id)
+        if entry is None or entry[1] != user_id:
+            return None
+        del self._entries[suggestion_id]
+        self._forget(suggestion_id, entry)
+        return entry[2]
+    
+    def __len__(self) -> int:
+        self._evict_expired()
+        return len(self._entries)
+
+suggestions_cache = PendingSuggestions()  # suggestion_id -> (owning user_id, suggestion)
 user_workflows: Dict[str, List[Dict]] = {}  # user_id -> current workflows for LLM context
 
+# In-process ID sequences; IDs are only used as keys into the stores above. The random
+# per-process tag keeps IDs from a previous run (e.g. a suggestion popup still open across a
+# reload) from colliding with new ones.
+_ID_TAG = secrets.token_hex(4)
+_action_ids = itertools.count(1)
+_suggestion_ids = itertools.count(1)
+_hook_ids = itertools.count(1)
+
+
+class LLMSuggestionCache:
+    """Two-tier cache of LLM pattern analyses: exact prompt hash, then embedding similarity.
+    
+    Entries are versioned by the user's accepted workflow descriptions and rejected
+    suggestions, so accepting or declining a suggestion invalidates results that did
+    not know about it. Semantic hits are
+    only taken from entries for the same current (action, sender), since generated
+    hook code targets that sender.
+    """
+    
+    def __init__(self, max_entries: int = 512, max_semantic_entries: int = 64, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.max_semantic_entries = max_semantic_entries
+        self.similarity_threshold = similarity_threshold
+        self._exact: "OrderedDict[str, SuggestionOut]" = OrderedDict()  # exact key -> result
+        # user_id -> (version, [(anchor, unit embedding, result)])
+        self._semantic: Dict[str, Tuple[str, List[Tuple[Tuple[str, str], List[float], SuggestionOut]]]] = {}
+    
+    @staticmethod
+    def version(user_id: str) -> str:
+        descriptions = sorted(hook.get('description', '') for hook in hook_functions.get(user_id, []))
+        rejected = sorted(rejected_suggestions.get(user_id, ()))
+        return hashlib.sha256(orjson.dumps([descriptions, rejected])).hexdigest()[:16]
+    
+    @classmethod
+    def _normalize(cls, value: Any) -> Any:
+        """Lowercase strings, drop timestamps and sort string lists (e.g. labels)"""
+        if isinstance(value, dict):
+            return {key: cls._normalize(item) for key, item in value.items() if key != "timestamp"}
+        if isinstance(value, list):
+            items = [cls._normalize(item) for item in value]
+            return sorted(items) if all(isinstance(item, str) for item in items) else items
+        if isinstance(value, str):
+            return value.strip().lower()
+        return value
+    
+    def _exact_key(self, user_id: str, version: str, prompt: Dict[str, Any]) -> str:
+        normalized = orjson.dumps(self._normalize(prompt), option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(f"{user_id}\n{version}\n".encode() + normalized).hexdigest()
+    
+    @staticmethod
+    def _anchor(prompt: Dict[str, Any]) -> Tuple[str, str]:
+        current = prompt["current_action"]
+        return str(current["action"]).lower(), str(current["sender"]).lower()
+    
+    @staticmethod
+    def _unit(embedding: List[float]) -> List[float]:
+        norm = math.sqrt(sum(map(operator.mul, embedding, embedding))) or 1.0
+        return [x / norm for x in embedding]
+    
+    def get_exact(self, user_id: str, version: str, prompt: Dict[str, Any]) -> Optional[SuggestionOut]:
+        key = self._exact_key(user_id, version, prompt)
+        result = self._exact.get(key)
+        if result is not None:
+            self._exact.move_to_end(key)
+        return result
+    
+    def get_similar(self, user_id: str, version: str, prompt: Dict[str, Any], embedding: Optional[List[float]]) -> Optional[SuggestionOut]:
+        cached_version, entries = self._semantic.get(user_id, ("", []))
+        if embedding is None or cached_version != version:
+            return None
+        
+        anchor = self._anchor(prompt)
+        query = self._unit(embedding)
+        best_score, best_result = 0.0, None
+        for entry_anchor, entry_embedding, result in entries:
+            if entry_anchor != anchor:
+                continue
+            score = sum(map(operator.mul, query, entry_embedding))
+            if score > best_score:
+                best_score, best_result = score, result
+        return best_result if best_score >= self.similarity_threshold else None
+    
+    def put(self, user_id: str, version: str, prompt: Dict[str, Any], result: SuggestionOut, embedding: Optional[List[float]] = None):
+        key = self._exact_key(user_id, version, prompt)
+        self._exact[key] = result
+        self._exact.move_to_end(key)
+        if len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)
+        
+        if embedding is None:
+            return
+        cached_version, entries = self._semantic.get(user_id, ("", []))
+        if cached_version != version:
+            entries = []
+        entries.append((self._anchor(prompt), self._unit(embedding), result))
+        self._semantic[user_id] = (version, entries[-self.max_semantic_entries:])
+
+llm_suggestion_cache = LLMSuggestionCache()
+
+async def _embed_action_pattern(client, prompt: Dict[str, Any]) -> Optional[List[float]]:
+    """Embed the action/sender sequence for the semantic cache tier"""
+    steps = prompt["recent_actions"] + [prompt["current_action"]]
+    text = "; ".join(f"{step['action']} {step['sender']}" for step in steps)
+    try:
+        response = await client.embeddings.create(model="text-embedding-3-small", input=text)
+        return response.data[0].embedding
+    except Exception as e:
+        log.warning("Embedding failed, skipping semantic cache: %s", e)
+        return None
+
 # Debouncing for LLM requests
-pending_analysis_tasks: Dict[str, asyncio.Task] = {}  # user_id -> analysis task
+pending_timers: Dict[str, asyncio.TimerHandle] = {}  # user_id -> armed debounce timer
+analysis_tasks: Set[asyncio.Task] = set()  # running analyses, referenced until done
+pending_deadlines: Dict[str, float] = {}  # user_id -> loop time after which analysis may run
+pending_latest_action: Dict[str, Dict[str, Any]] = {}  # user_id -> newest action dict awaiting analysis
 analysis_debounce_delay = 1.0  # 1 second debounce delay
 
 
+# Precompiled patterns for the keyword-based LLM helpers
+_EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b')
+# Keyword alternations match substrings (e.g. "newsletters", "deals"), like the original `in` checks
+_NEWSLETTER_RE = re.compile('|'.join(map(re.escape, ['newsletter', 'unsubscribe', 'weekly', 'monthly', 'digest'])))
+_PROMO_RE = re.compile('|'.join(map(re.escape, ['sale', 'discount', 'offer', 'deal', 'promo', '%', 'save'])))
+
+
 class Context:
     """Context object available in workflow functions"""
     def __init__(self, context_data: Dict[str, Any]):
@@ -106,16 +320,12 @@ class LLMHelpers:
         text_lower = text.lower()
         
         # Newsletter detection
-        if 'newsletter' in categories:
-            newsletter_keywords = ['newsletter', 'unsubscribe', 'weekly', 'monthly', 'digest']
-            if any(keyword in text_lower for keyword in newsletter_keywords):
-                return 'newsletter'
+        if 'newsletter' in categories and _NEWSLETTER_RE.search(text_lower):
+            return 'newsletter'
         
         # Promotion detection
-        if 'promotion' in categories:
-            promo_keywords = ['sale', 'discount', 'offer', 'deal', 'promo', '%', 'save']
-            if any(keyword in text_lower for keyword in promo_keywords):
-                return 'promotion'
+        if 'promotion' in categories and _PROMO_RE.search(text_lower):
+            return 'promotion'
         
         # Default to first category
         return categories[0] if categories else 'unknown'
@@ -130,9 +340,8 @@ class LLMHelpers:
         for field, field_type in schema.items():
             if field_type == 'email':
                 # Simple email extraction
-                import re
-                emails = re.findall(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', text)
-                result[field] = emails[0] if emails else None
+                match = _EMAIL_RE.search(text)
+                result[field] = match.group(0) if match else None
             elif field_type == 'date':
                 # Simple date extraction (placeholder)
                 result[field] = datetime.now().isoformat()
@@ -175,42 +384,107 @@ class LLMHelpers:
 
 # Global LLM helpers instance
 llm = LLMHelpers()
-user_sessions: Dict[str, List[str]] = {}  # user_id -> recent actions for context
 
 # WebSocket Connection Manager
+def _encode_json(message: Dict[str, Any]) -> str:
+    """Serialize a websocket message with orjson; text frames because the browser client JSON.parses them"""
+    return orjson.dumps(message).decode()
+
+MSGPACK_SUBPROTOCOL = "msgpack"  # Opt-in binary frames for high-rate clients
+
+def _json_safe(value: Any) -> Any:
+    """Coerce msgpack-decoded data to JSON's model: str keys, no bin or ext values.
+    
+    Stored actions are served back by orjson, which rejects both, so this runs at ingest.
+    """
+    if isinstance(value, dict):
+        return {
+            (key if isinstance(key, str) else key.decode('utf-8', 'replace') if isinstance(key, bytes) else str(key)): _json_safe(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
 class ConnectionManager:
+    """Tracks open websockets; connect() and disconnect() are the only mutators"""
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        self.active_connections: Dict[str, WebSocket] = {}  # "user_id:session_id" -> websocket
         self.user_sessions: Dict[str, Set[str]] = {}
+        self.binary_connections: Set[str] = set()  # connection keys speaking msgpack
     
     async def connect(self, websocket: WebSocket, user_id: str, session_id: str):
-        await websocket.accept()
         connection_key = f"{user_id}:{session_id}"
+        if msgpack is not None and MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+            await websocket.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+            self.binary_connections.add(connection_key)
+        else:
+            await websocket.accept()
         self.active_connections[connection_key] = websocket
         
         if user_id not in self.user_sessions:
             self.user_sessions[user_id] = set()
         self.user_sessions[user_id].add(session_id)
         
-        print(f"User {user_id} session {session_id} connected")
+        log.info("User %s session %s connected", user_id, session_id)
     
     def disconnect(self, user_id: str, session_id: str):
         connection_key = f"{user_id}:{session_id}"
-        if connection_key in self.active_connections:
-            del self.active_connections[connection_key]
+        self.active_connections.pop(connection_key, None)
+        self.binary_connections.discard(connection_key)
         
         if user_id in self.user_sessions:
             self.user_sessions[user_id].discard(session_id)
             if not self.user_sessions[user_id]:
                 del self.user_sessions[user_id]
+                cancel_pattern_analysis(user_id)
         
-        print(f"User {user_id} session {session_id} disconnected")
+        log.info("User %s session %s disconnected", user_id, session_id)
     
-    async def send_suggestion(self, user_id: str, suggestion: WorkflowSuggestion):
-        """Send workflow suggestion to all user sessions"""
+    async def send_message(self, connection_key: str, message: Dict[str, Any]):
+        """Send a message to one connection using its negotiated encoding"""
+        websocket = self.active_connections[connection_key]
+        if connection_key in self.binary_connections:
+            await websocket.send_bytes(msgpack.packb(message))
+        else:
+            await websocket.send_text(_encode_json(message))
+    
+    async def _broadcast(self, user_id: str, message: Dict[str, Any], kind: str):
+        """Send a message to all user sessions concurrently, encoding it once per protocol"""
         if user_id not in self.user_sessions:
             return
         
+        text_payload: Optional[str] = None
+        binary_payload: Optional[bytes] = None
+        session_ids: List[str] = []
+        sends = []
+        for session_id in self.user_sessions[user_id]:
+            connection_key = f"{user_id}:{session_id}"
+            websocket = self.active_connections.get(connection_key)
+            if websocket is None:
+                continue
+            if connection_key in self.binary_connections:
+                if binary_payload is None:
+                    binary_payload = msgpack.packb(message)
+                sends.append(websocket.send_bytes(binary_payload))
+            else:
+                if text_payload is None:
+                    text_payload = _encode_json(message)
+                sends.append(websocket.send_text(text_payload))
+            session_ids.append(session_id)
+        
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for session_id, result in zip(session_ids, results):
+            if isinstance(result, Exception):
+                log.warning("Failed to send %s to %s:%s: %s", kind, user_id, session_id, result)
+                self.disconnect(user_id, session_id)
+    
+    async def send_suggestion(self, user_id: str, suggestion: WorkflowSuggestion):
+        """Send workflow suggestion to all user sessions"""
         message = {
             "type": "workflow_suggestion",
             "data": {
@@ -222,65 +496,65 @@ class ConnectionManager:
                 "trigger_event": suggestion.trigger_event
             }
         }
-        
-        for session_id in self.user_sessions[user_id].copy():
-            connection_key = f"{user_id}:{session_id}"
-            if connection_key in self.active_connections:
-                try:
-                    await self.active_connections[connection_key].send_text(
-                        json.dumps(message)
-                    )
-                except Exception as e:
-                    print(f"Failed to send suggestion to {connection_key}: {e}")
-                    self.disconnect(user_id, session_id)
+        await self._broadcast(user_id, message, "suggestion")
     
     async def send_workflow_notification(self, user_id: str, notification: Dict[str, Any]):
         """Send workflow execution notification to all user sessions"""
-        if user_id not in self.user_sessions:
-            return
-        
         message = {
             "type": "workflow_notification",
             "data": notification
         }
-        
-        for session_id in self.user_sessions[user_id].copy():
-            connection_key = f"{user_id}:{session_id}"
-            if connection_key in self.active_connections:
-                try:
-                    await self.active_connections[connection_key].send_text(
-                        json.dumps(message)
-                    )
-                except Exception as e:
-                    print(f"Failed to send workflow notification to {connection_key}: {e}")
-                    self.disconnect(user_id, session_id)
+        await self._broadcast(user_id, message, "workflow notification")
 
 manager = ConnectionManager()
 
 # Helper Functions
-def store_user_action(action: UserAction) -> str:
-    """Store user action in memory"""
-    action.id = str(uuid.uuid4())
-    
-    if action.user_id not in action_logs:
-        action_logs[action.user_id] = []
+def _pattern_key(action: Dict[str, Any]) -> Tuple[str, str, str]:
+    """(action, sender, location) key counted in the prompt's history table"""
+    sender = action["email"].get('sender', '')
+    location = action["context"].get('location', 'unknown')
+    return (
+        action["action"].value,
+        sender if isinstance(sender, str) else str(sender),
+        location if isinstance(location, str) else str(location),
+    )
+
+def store_user_action(action: Dict[str, Any]) -> str:
+    """Store a user action dict (UserAction fields, unvalidated) in memory"""
+    global _total_actions
+    # Built before anything is stored, so a malformed action can't leave partial state behind
+    key = _pattern_key(action)
+    action["id"] = f"a-{_ID_TAG}-{next(_action_ids)}"
     
-    action_logs[action.user_id].append(action)
+    # Bounded deque drops the oldest action in O(1) once full
+    user_id = action["user_id"]
+    user_actions = action_logs.setdefault(user_id, deque(maxlen=MAX_ACTIONS_PER_USER))
+    if len(user_actions) < MAX_ACTIONS_PER_USER:
+        _total_actions += 1
+    user_actions.append(action)
     
-    # Keep only last 100 actions per user for memory efficiency
-    if len(action_logs[action.user_id]) > 100:
-        action_logs[action.user_id] = action_logs[action.user_id][-100:]
+    # Keep the prompt's pattern counts current so analysis doesn't rebuild them
+    window = action_pattern_window.setdefault(user_id, deque())
+    counts = action_pattern_counts.setdefault(user_id, Counter())
+    if len(window) == PATTERN_HISTORY_WINDOW:
+        expired = window.popleft()
+        counts[expired] -= 1
+        if not counts[expired]:
+            del counts[expired]
+    window.append(key)
+    counts[key] += 1
     
-    return action.id
+    return action["id"]
 
-def get_user_actions(user_id: str, limit: int = 20) -> List[UserAction]:
+def get_user_actions(user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
     """Get recent user actions"""
     if user_id not in action_logs:
         return []
     
-    return action_logs[user_id][-limit:]
+    actions = action_logs[user_id]
+    return list(itertools.islice(actions, max(0, len(actions) - limit), None))
 
-def should_analyze_for_patterns(user_id: str, current_action: UserAction) -> bool:
+def should_analyze_for_patterns(user_id: str, current_action: Dict[str, Any]) -> bool:
     """Decide when to call LLM for analysis based on intentional actions and sufficient history"""
     recent_actions = get_user_actions(user_id, 20)
     
@@ -296,80 +570,166 @@ def should_analyze_for_patterns(user_id: str, current_action: UserAction) -> boo
     }
     
     # Only analyze for intentional actions
-    if current_action.action not in intentional_actions:
+    if current_action["action"] not in intentional_actions:
         return False
 
-    print(f"\n=== PATTERN ANALYSIS CHECK ===")
-    print(f"Current action: {current_action.action} on email from {current_action.email.get('sender', 'unknown')}")
-    print(f"Total recent actions: {len(recent_actions)}")
-    
-    # Show recent actions for context
-    print(f"Recent actions:")
-    for i, action in enumerate(recent_actions[-5:]):
-        marker = "👉" if action.action == current_action.action else "  "
-        print(f"  {marker} {action.action} on email from {action.email.get('sender', 'unknown')}")
-    
-    print(f"✅ TRIGGERING LLM ANALYSIS - Intentional action with sufficient history")
-    print(f"=== END PATTERN CHECK ===\n")
+    # Skip building the banner entirely unless debugging
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("=== PATTERN ANALYSIS CHECK ===")
+        log.debug("Current action: %s on email from %s", current_action["action"], current_action["email"].get('sender', 'unknown'))
+        log.debug("Total recent actions: %d", len(recent_actions))
+        
+        # Show recent actions for context
+        log.debug("Recent actions:")
+        for action in recent_actions[-5:]:
+            marker = "👉" if action["action"] == current_action["action"] else "  "
+            log.debug("  %s %s on email from %s", marker, action["action"], action["email"].get('sender', 'unknown'))
+        
+        log.debug("✅ TRIGGERING LLM ANALYSIS - Intentional action with sufficient history")
+        log.debug("=== END PATTERN CHECK ===")
     return True
 
 # NOTE: Python API documentation removed since workflow execution moved to JavaScript frontend
 
-async def debounced_analyze_patterns(user_id: str, current_action: UserAction) -> None:
-    """Debounced wrapper for LLM analysis to prevent overwhelming the LLM with rapid requests"""
-    print(f"⏱️ Starting debounced analysis for user {user_id} (delay: {analysis_debounce_delay}s)")
-    
-    # Wait for debounce delay
-    await asyncio.sleep(analysis_debounce_delay)
+def cancel_pattern_analysis(user_id: str) -> None:
+    """Drop the user's armed debounce timer and pending action"""
+    timer = pending_timers.pop(user_id, None)
+    if timer is not None:
+        timer.cancel()
+    pending_deadlines.pop(user_id, None)
+    pending_latest_action.pop(user_id, None)
+
+def schedule_pattern_analysis(user_id: str, action: Dict[str, Any]) -> None:
+    """Push the user's analysis deadline back, arming a timer only if none is pending"""
+    loop = asyncio.get_running_loop()
+    pending_deadlines[user_id] = loop.time() + analysis_debounce_delay
+    pending_latest_action[user_id] = action
+    if user_id not in pending_timers:
+        pending_timers[user_id] = loop.call_at(pending_deadlines[user_id], _on_analysis_timer, user_id)
+
+def _on_analysis_timer(user_id: str) -> None:
+    """Debounce timer callback; creates the analysis task only once actions have settled"""
+    loop = asyncio.get_running_loop()
+    deadline = pending_deadlines.get(user_id)
+    if deadline is not None and deadline > loop.time():
+        # A newer action moved the deadline; re-arm rather than cancel on every action
+        pending_timers[user_id] = loop.call_at(deadline, _on_analysis_timer, user_id)
+        return
     
-    # Check if this task was cancelled (newer action arrived)
-    current_task = asyncio.current_task()
-    if user_id in pending_analysis_tasks and pending_analysis_tasks[user_id] != current_task:
-        print(f"🚫 Analysis cancelled for user {user_id} - newer action received")
+    pending_timers.pop(user_id, None)
+    pending_deadlines.pop(user_id, None)
+    action_data = pending_latest_action.pop(user_id, None)
+    if action_data is None:
         return
     
-    print(f"🔍 Proceeding with LLM analysis for user {user_id}...")
-    suggestion = await analyze_action_patterns_with_llm(user_id, current_action)
+    task = asyncio.create_task(debounced_analyze_patterns(user_id, action_data))
+    analysis_tasks.add(task)  # Hold a reference until done; the loop only keeps weak ones
+    task.add_done_callback(analysis_tasks.discard)
+
+async def debounced_analyze_patterns(user_id: str, action_data: Dict[str, Any]) -> None:
+    """Run LLM analysis for the action that ended a debounce window"""
+    log.info("🔍 Proceeding with LLM analysis for user %s...", user_id)
+    try:
+        # Only actions that reach analysis pay for full model validation
+        current_action = UserAction(**action_data)
+        suggestion = await analyze_action_patterns_with_llm(user_id, current_action)
+    except Exception as e:
+        log.warning("Pattern analysis failed for user %s: %s", user_id, e)
+        return
     
     if suggestion:
-        print(f"✨ Generated suggestion: {suggestion.description}")
-        print(f"   Confidence: {suggestion.confidence}")
-        print(f"   Trigger event: {suggestion.trigger_event}")
+        log.info(
+            "✨ Generated suggestion: %s (confidence: %s, trigger event: %s)",
+            suggestion.description, suggestion.confidence, suggestion.trigger_event
+        )
         await manager.send_suggestion(user_id, suggestion)
     else:
-        print(f"❌ LLM analysis completed but no suggestion generated")
+        log.info("❌ LLM analysis completed but no suggestion generated")
+
+# JavaScript email methods for actions the trivial-pattern detector can automate
+_JS_ACTION_METHODS = {
+    ActionType.ARCHIVE: "archive",
+    ActionType.DELETE: "delete",
+    ActionType.STAR: "star",
+    ActionType.UNSTAR: "unstar",
+    ActionType.MARK_READ: "markRead",
+    ActionType.MARK_UNREAD: "markUnread",
+}
+TRIVIAL_PATTERN_WINDOW = 15
+TRIVIAL_PATTERN_MIN_REPEATS = 3
+
+def _detect_trivial_pattern(actions: List[Dict[str, Any]], current_action: UserAction) -> Optional[WorkflowSuggestion]:
+    """Suggest a sender rule without the LLM when the current action repeats on one sender"""
+    js_method = _JS_ACTION_METHODS.get(current_action.action)
+    sender = current_action.email.get('sender')
+    if js_method is None or not sender:
+        return None
+    
+    repeats = sum(
+        1 for action in actions[-TRIVIAL_PATTERN_WINDOW:]
+        if action["action"] == current_action.action and action["email"].get('sender') == sender
+    )
+    if repeats < TRIVIAL_PATTERN_MIN_REPEATS:
+        return None
     
-    # Clean up task reference
-    if user_id in pending_analysis_tasks and pending_analysis_tasks[user_id] == current_task:
-        del pending_analysis_tasks[user_id]
+    return WorkflowSuggestion(
+        id=f"s-{_ID_TAG}-{next(_suggestion_ids)}",
+        description=f"Automatically {current_action.action.value.replace('_', ' ')} emails from {sender}?",
+        confidence=0.95,
+        reasoning=f"{repeats} repeated {current_action.action.value} on emails from {sender}",
+        generated_function=f"if (email.sender === {orjson.dumps(sender).decode()}) {{\n  email.{js_method}();\n}}",
+        trigger_event="email_received"
+    )
+
+# Static, so it is built once and the provider can reuse its cached prefix;
+# bump PROMPT_CACHE_KEY whenever it changes
+_SYSTEM_PROMPT: Final[str] = """
+You suggest email automations from a user's recent actions. Only suggest when a clear, repeated pattern with real benefit exists, no similar workflow exists, and confidence is 0.8+.
+
+hook_function is a JavaScript code block run with eval() - plain statements, never a function declaration or arrow function. Example:
+if (email.sender === 'newsletter@example.com') {
+  email.archive();
+}
+
+email fields: id, sender, subject, body, labels (array), is_read, is_starred, received_at (Date)
+email methods: archive(), delete(), star(), unstar(), markRead(), markUnread(), addLabel(name), removeLabel(name), moveToSpam(), moveToTrash()
+context fields: user_id, location ('home'|'detail'), time_of_day (0-23), day_of_week (0-6, 0=Sunday)
+"""
+
+PROMPT_CACHE_KEY: Final[str] = "workflow_analyzer_v1"
 
 async def analyze_action_patterns_with_llm(user_id: str, current_action: UserAction):
     """Use LLM to analyze user action patterns and suggest automations"""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key or OpenAI is None:
-        print(f"⚠️  No OpenAI API key found, falling back to simple analysis")
+    # Obvious same-action/same-sender repeats don't need an LLM round trip
+    suggestion = _detect_trivial_pattern(get_user_actions(user_id, limit=TRIVIAL_PATTERN_WINDOW), current_action)
+    if suggestion is not None:
+        if any(hook.get('function_code') == suggestion.generated_function for hook in hook_functions.get(user_id, [])):
+            return None  # Already automated
+        if suggestion.generated_function in rejected_suggestions.get(user_id, ()):
+            return None  # User already declined this rule
+        if suggestions_cache.has_pending(user_id, suggestion.generated_function):
+            return None  # Still waiting on the user's answer to this rule
+        suggestions_cache.add(user_id, suggestion)
+        return suggestion
+    
+    client = get_openai_client()
+    if client is None:
+        log.warning("⚠️  No OpenAI API key found, falling back to simple analysis")
         return await analyze_action_patterns_fallback(user_id, current_action)
     
     try:
-        client = OpenAI(api_key=api_key)
-        actions = get_user_actions(user_id, limit=30)  # More context for better analysis
         existing_workflows = hook_functions.get(user_id, [])
         
-        # Prepare comprehensive action history for LLM
-        action_history = []
-        for action in actions[-20:]:  # Last 20 actions for context
-            action_history.append({
-                "action": action.action,
-                "sender": action.email.get('sender', ''),
-                "subject": action.email.get('subject', ''),
-                "location": action.context.get('location', 'unknown'),
-                "timestamp": action.timestamp.isoformat(),
-                "labels": action.email.get('labels', []),
-                "is_read": action.email.get('is_read', False)
-            })
+        # History is a counts table so the prompt grows with unique patterns, not actions;
+        # sorted so identical windows give identical prompts (and exact cache hits)
+        pattern_counts = action_pattern_counts.get(user_id, Counter())
+        action_history = [
+            {"action": action_type, "sender": sender, "location": location, "count": count}
+            for (action_type, sender, location), count in sorted(pattern_counts.items(), key=lambda item: (-item[1], item[0]))
+        ]
         
         current_action_data = {
-            "action": current_action.action,
+            "action": current_action.action.value,
             "sender": current_action.email.get('sender', ''),
             "subject": current_action.email.get('subject', ''),
             "location": current_action.context.get('location', 'unknown'),
@@ -385,192 +745,204 @@ async def analyze_action_patterns_with_llm(user_id: str, current_action: UserAct
                 "trigger_event": workflow.get('trigger_event', 'email_received')
             })
         
-        system_prompt = """
-You are an intelligent email automation assistant. Analyze user email actions to detect meaningful patterns and suggest practical automations.
-
-CRITICAL: Generate JavaScript code blocks (NOT function declarations). The frontend executes JavaScript using eval().
-
-JavaScript Email API Available:
-- email.id - Email ID (string)
-- email.sender - Sender email address (string)  
-- email.subject - Email subject (string)
-- email.body - Email body content (string)
-- email.labels - Array of label strings
-- email.is_read - Boolean if email is read
-- email.is_starred - Boolean if email is starred
-- email.received_at - Date object when received
-
-JavaScript Actions Available:
-- email.archive() - Archive the email
-- email.delete() - Delete the email
-- email.star() - Star the email
-- email.unstar() - Remove star
-- email.markRead() - Mark as read
-- email.markUnread() - Mark as unread
-- email.addLabel(labelName) - Add a label
-- email.removeLabel(labelName) - Remove a label
-- email.moveToSpam() - Move to spam
-- email.moveToTrash() - Move to trash
-
-Context API Available:
-- context.user_id - User ID (string)
-- context.location - Where action occurred ('home', 'detail')
-- context.time_of_day - Hour of day (0-23)
-- context.day_of_week - Day of week (0-6, 0=Sunday)
-
-IMPORTANT: Generate JavaScript code blocks, NOT function declarations. Examples:
-
-CORRECT format for hook_function:
-```
-if (email.sender === 'newsletter@example.com') {
-  email.archive();
-  console.log('Auto-archived newsletter');
-}
-```
-
-WRONG format (DO NOT USE):
-```
-function() { ... }
-() => { ... }
-(function() { ... })
-```
-
-Your task:
-1. Analyze the user's recent actions to identify clear, actionable patterns
-2. Check if similar workflows already exist to avoid duplicates
-3. Only suggest automations with high confidence (0.8+) and clear user benefit
-4. Generate executable JavaScript code blocks (NOT function declarations)
-
-Return JSON with:
-- "should_suggest": boolean (true only if strong pattern detected and no duplicate exists)
-- "description": string (clear, actionable suggestion like "Auto-archive newsletters from this sender?")
-- "confidence": float 0-1 (only suggest if 0.8+)
-- "reasoning": string (detailed explanation of detected pattern)
-- "hook_function": string (JavaScript code block - NO function wrapper, just the code)
-- "pattern_type": string ("sender_based", "subject_based", "content_based", "time_based", etc.)
-- "trigger_event": string ("email_received", "email_closed", "user_action")
-
-
-Pattern detection criteria:
-- Sender-based: Same action on emails from same sender
-- Subject-based: Same action on emails with similar subjects (newsletters, notifications)
-- Content-based: Same action on emails with similar content patterns
-- Time-based: Actions that happen at specific times or days
-- Sequential: Multi-step action patterns
-- Location-based: Actions that vary by interface location
-
-Only suggest if:
-- Clear pattern detected in recent actions
-- No similar existing workflow
-- Clear user benefit
-"""
-        
         user_prompt = {
             "current_action": current_action_data,
             "recent_actions": action_history,
             "existing_workflows": existing_workflow_summaries,
-            "analysis_request": "Analyze if the current action completes a pattern worthy of automation"
         }
         
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(user_prompt, indent=2)}
-            ],
-            temperature=0.2  # Lower temperature for more consistent analysis
-        )
+        cache_version = llm_suggestion_cache.version(user_id)
+        result = llm_suggestion_cache.get_exact(user_id, cache_version, user_prompt)
+        embedding = None
+        if result is None:
+            embedding = await _embed_action_pattern(client, user_prompt)
+            result = llm_suggestion_cache.get_similar(user_id, cache_version, user_prompt, embedding)
+        
+        if result is not None:
+            log.info("♻️ Reusing cached LLM analysis for user %s", user_id)
+        else:
+            completion = await client.beta.chat.completions.parse(
+                model="gpt-4o-mini",
+                response_format=SuggestionOut,
+                messages=[
+                    {"role": "system", "content": _SYSTEM_PROMPT},
+                    {"role": "user", "content": orjson.dumps(user_prompt).decode()}  # Compact: no whitespace tokens
+                ],
+                temperature=0.2,  # Lower temperature for more consistent analysis
+                # Sent as a raw body field: SDKs older than the parameter would reject the keyword
+                extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+            )
+            
+            result = completion.choices[0].message.parsed
+            if result is None:  # Model refused
+                return None
+            llm_suggestion_cache.put(user_id, cache_version, user_prompt, result, embedding)
         
-        result = json.loads(completion.choices[0].message.content)
+        if result.hook_function in rejected_suggestions.get(user_id, ()):
+            return None  # User already declined this rule
+        if suggestions_cache.has_pending(user_id, result.hook_function):
+            return None  # Still waiting on the user's answer to this rule
         
-        if result.get("should_suggest", False) and result.get("confidence", 0) >= 0.8:
+        if result.should_suggest and result.confidence >= 0.8:
             suggestion = WorkflowSuggestion(
-                id=str(uuid.uuid4()),
-                description=result.get("description", "Automation suggestion"),
-                confidence=result.get("confidence", 0.8),
-                reasoning=result.get("reasoning", "Pattern detected"),
-                generated_function=result.get("hook_function", ""),
-                trigger_event=result.get("trigger_event", "email_received"),
-                created_at=datetime.now()
+                id=f"s-{_ID_TAG}-{next(_suggestion_ids)}",
+                description=result.description or "Automation suggestion",
+                confidence=result.confidence,
+                reasoning=result.reasoning or "Pattern detected",
+                generated_function=result.hook_function,
+                trigger_event=result.trigger_event
             )
             
-            suggestions_cache[suggestion.id] = suggestion
+            suggestions_cache.add(user_id, suggestion)
             return suggestion
             
     except Exception as e:
-        print(f"LLM analysis failed: {e}")
+        log.warning("LLM analysis failed: %s", e)
     
     return None
 
 def store_accepted_suggestion(user_id: str, suggestion: WorkflowSuggestion):
     """Store accepted suggestion as a hook function"""
+    global _total_hooks
     if user_id not in hook_functions:
         hook_functions[user_id] = []
     
     hook = {
-        "id": str(uuid.uuid4()),
+        "id": f"h-{_ID_TAG}-{next(_hook_ids)}",
         "name": f"auto_workflow_{len(hook_functions[user_id])}",
         "description": suggestion.description,
         "function_code": suggestion.generated_function,
         "trigger_event": suggestion.trigger_event,
         "enabled": True,
-        "created_at": datetime.now(),
+        "created_at": datetime.now().isoformat(),
         "execution_count": 0,
         "last_executed": None
     }
+    compile_workflow_hook(hook)
     
     hook_functions[user_id].append(hook)
+    _total_hooks += 1
+    hooks_by_trigger.setdefault(user_id, {}).setdefault(hook['trigger_event'], []).append(hook)
     return hook
 
+def reindex_hooks(user_id: str, trigger_event: str) -> None:
+    """Rebuild the enabled-hook index for one trigger after a toggle or delete"""
+    hooks = [
+        hook for hook in hook_functions.get(user_id, [])
+        if hook.get('enabled', True) and hook.get('trigger_event', 'email_received') == trigger_event
+    ]
+    user_index = hooks_by_trigger.setdefault(user_id, {})
+    if hooks:
+        user_index[trigger_event] = hooks
+    else:
+        user_index.pop(trigger_event, None)
+
+def _workflow_namespace() -> Dict[str, Any]:
+    """Helpers available to generated workflow code"""
+    return {
+        'llm': llm,
+        'hook': lambda event_type: lambda func: func,  # Decorator that just returns the function
+        'Email': Email,
+        'Context': Context,
+        'datetime': datetime,
+        'asyncio': asyncio
+    }
+
+def _find_workflow_func(namespace: Dict[str, Any], predefined_count: int) -> Optional[Callable]:
+    """Return the first coroutine function defined by exec'd hook code.
+    
+    Dicts keep insertion order, so names the code defined come after the
+    predefined helpers and only those are checked.
+    """
+    for name in itertools.islice(namespace, predefined_count, None):
+        obj = namespace[name]
+        if not name.startswith('_') and inspect.iscoroutinefunction(obj):
+            return obj
+    return None
+
+def compile_workflow_hook(hook: Dict[str, Any]) -> None:
+    """Compile a hook's code once and cache its workflow coroutine on the hook as '_func'.
+    
+    Plain code blocks (no async def) are flagged '_is_block_only' and are not exec'd
+    here, since they act on the email directly and only make sense per event. Hooks
+    that aren't Python (LLM suggestions and sender rules are JavaScript, run by the
+    frontend) are left uncompiled.
+    """
+    try:
+        tree = ast.parse(hook['function_code'])
+    except SyntaxError:
+        log.debug("Workflow %s is not Python code, skipping precompilation", hook['id'])
+        return
+    
+    try:
+        code_obj = compile(tree, f"<hook:{hook['id']}>", "exec")
+        if not any(isinstance(node, ast.AsyncFunctionDef) for node in ast.walk(tree)):
+            hook['_code'] = code_obj
+            hook['_is_block_only'] = True
+            return
+        
+        namespace = _workflow_namespace()
+        predefined_count = len(namespace)
+        exec(code_obj, namespace)
+    except Exception as e:
+        log.warning("Could not precompile workflow %s, will run it uncompiled: %s", hook['id'], e)
+        return
+    
+    hook['_code'] = code_obj
+    hook['_func'] = _find_workflow_func(namespace, predefined_count)
+
 async def execute_workflow_hooks(user_id: str, trigger_event: str, email_data: Dict[str, Any], context_data: Dict[str, Any]):
     """Execute all enabled workflow hooks for a given trigger event"""
-    if user_id not in hook_functions:
+    hooks = hooks_by_trigger.get(user_id, {}).get(trigger_event)
+    if not hooks:
         return []
     
+    # Hooks get their own Email/Context, so they can run concurrently
+    results = await asyncio.gather(
+        *(execute_single_workflow(hook, email_data, context_data) for hook in hooks),
+        return_exceptions=True
+    )
+    
+    global _total_executions
     executed_workflows = []
+    notifications = []
     
-    for hook in hook_functions[user_id]:
-        if not hook.get('enabled', True):
-            continue
-            
-        if hook.get('trigger_event', 'email_received') != trigger_event:
-            continue
-            
-        try:
-            # Execute the workflow hook
-            result = await execute_single_workflow(hook, email_data, context_data)
-            if result:
-                # Update execution stats
-                hook['execution_count'] = hook.get('execution_count', 0) + 1
-                hook['last_executed'] = datetime.now()
-                
-                executed_workflows.append({
-                    'hook_id': hook['id'],
-                    'description': hook['description'],
-                    'result': result,
-                    'executed_at': datetime.now()
-                })
-                
-                # Send notification to user
-                await manager.send_workflow_notification(user_id, {
-                    'type': 'workflow_executed',
-                    'hook_id': hook['id'],
-                    'description': hook['description'],
-                    'result': result,
-                    'can_undo': True  # Stub for future undo functionality
-                })
-                
-        except Exception as e:
-            print(f"Error executing workflow {hook['id']}: {e}")
+    for hook, result in zip(hooks, results):
+        if isinstance(result, Exception):
+            log.warning("Error executing workflow %s: %s", hook['id'], result)
             # Send error notification
-            await manager.send_workflow_notification(user_id, {
+            notifications.append({
                 'type': 'workflow_error',
                 'hook_id': hook['id'],
                 'description': hook['description'],
-                'error': str(e)
+                'error': str(result)
+            })
+        elif result:
+            # Update execution stats, unless the hook was deleted while it ran
+            if not hook.get('_deleted'):
+                hook['execution_count'] = hook.get('execution_count', 0) + 1
+                _total_executions += 1
+            hook['last_executed'] = datetime.now().isoformat()
+            
+            executed_workflows.append({
+                'hook_id': hook['id'],
+                'description': hook['description'],
+                'result': result,
+                'executed_at': datetime.now()
+            })
+            
+            # Send notification to user
+            notifications.append({
+                'type': 'workflow_executed',
+                'hook_id': hook['id'],
+                'description': hook['description'],
+                'result': result,
+                'can_undo': True  # Stub for future undo functionality
             })
     
+    for notification in notifications:
+        await manager.send_workflow_notification(user_id, notification)
+    
     return executed_workflows
 
 async def execute_single_workflow(hook: Dict[str, Any], email_data: Dict[str, Any], context_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -580,38 +952,38 @@ async def execute_single_workflow(hook: Dict[str, Any], email_data: Dict[str, An
         email = Email(email_data)
         context = Context(context_data)
         
-        # Get the generated function code
-        function_code = hook.get('function_code', '')
-        if not function_code:
-            return None
-        
-        # Create execution namespace with available objects
-        namespace = {
-            'email': email,
-            'context': context,
-            'llm': llm,
-            'hook': lambda event_type: lambda func: func,  # Decorator that just returns the function
-            'Email': Email,
-            'Context': Context,
-            'datetime': datetime,
-            'asyncio': asyncio
-        }
+        if hook.get('_is_block_only'):
+            # No function to discover or call; the block acts on the email directly
+            namespace = _workflow_namespace()
+            namespace.update({'email': email, 'context': context})
+            exec(hook['_code'], namespace)
+            return {
+                'actions_taken': email._actions_taken,
+                'email_id': email.id
+            }
         
-        # Execute the function code to define it
-        exec(function_code, namespace)
-        
-        # Find the workflow function (should be the only async function defined)
-        workflow_func = None
-        for name, obj in namespace.items():
-            if (callable(obj) and 
-                not name.startswith('_') and 
-                name not in ['email', 'context', 'llm', 'hook', 'Email', 'Context', 'datetime', 'asyncio'] and
-                inspect.iscoroutinefunction(obj)):
-                workflow_func = obj
-                break
+        if '_code' in hook:
+            # Precompiled when the suggestion was accepted
+            workflow_func = hook['_func']
+        else:
+            # Legacy path for hooks that could not be precompiled
+            function_code = hook.get('function_code', '')
+            if not function_code:
+                return None
+            
+            # Create execution namespace with available objects
+            namespace = _workflow_namespace()
+            namespace.update({'email': email, 'context': context})
+            predefined_count = len(namespace)
+            
+            # Execute the function code to define it
+            exec(function_code, namespace)
+            
+            # Find the workflow function (should be the only async function defined)
+            workflow_func = _find_workflow_func(namespace, predefined_count)
         
         if workflow_func is None:
-            print(f"No workflow function found in generated code")
+            log.warning("No workflow function found in generated code")
             return None
         
         # Execute the workflow function
@@ -628,114 +1000,140 @@ async def execute_single_workflow(hook: Dict[str, Any], email_data: Dict[str, An
         return execution_result
         
     except Exception as e:
-        print(f"Error executing workflow function: {e}")
-        print(f"Function code was: {hook.get('function_code', 'N/A')}")
+        log.warning("Error executing workflow function: %s\nFunction code was: %s", e, hook.get('function_code', 'N/A'))
         return {
             'error': str(e),
             'function_code': hook.get('function_code', ''),
             'email_id': email_data.get('id', 'unknown')
         }
 
+# WebSocket message handlers: (user_id, session_id, connection_key, message data)
+def _handle_user_action(user_id: str, session_id: str, connection_key: str, action_data: Dict[str, Any]) -> None:
+    """Record a user action; synchronous since it is the bulk of websocket traffic"""
+    # Cheap shape checks instead of a full UserAction validation on this hot path;
+    # malformed actions are dropped before anything is stored
+    email = action_data.get("email") or {}
+    context = action_data.get("context") or {}
+    duration = action_data.get("duration")
+    if not isinstance(email, dict) or not isinstance(context, dict) or not (duration is None or type(duration) is int):
+        log.warning("Ignoring malformed user_action from %s", user_id)
+        return
+    
+    action = {
+        "action": ActionType(action_data["action"]),
+        "timestamp": datetime.now(),
+        "email": email,
+        "user_id": user_id,
+        "session_id": session_id,
+        "context": context,
+        "duration": duration,
+    }
+    action_id = store_user_action(action)
+    
+    log.debug("Stored action %s: %s on email from %s", action_id, action["action"], action["email"].get('sender'))
+    
+    # Check if we should analyze for patterns with debouncing
+    if should_analyze_for_patterns(user_id, action):
+        log.debug("⏱️ Scheduling debounced LLM analysis for user %s...", user_id)
+        schedule_pattern_analysis(user_id, action)
+
+async def _handle_suggestion_response(user_id: str, session_id: str, connection_key: str, response_data: Dict[str, Any]) -> None:
+    """Handle user's response to suggestion"""
+    suggestion_id = response_data["suggestion_id"]
+    accepted = response_data["accepted"]
+    
+    # Answered suggestions leave the cache either way; only the user they were made for can answer
+    suggestion = suggestions_cache.pop(user_id, suggestion_id)
+    if not accepted and suggestion is not None:
+        # Remember the rule so the same suggestion isn't offered again
+        rejected_suggestions.setdefault(user_id, set()).add(suggestion.generated_function)
+    if accepted and suggestion is not None:
+        hook = store_accepted_suggestion(user_id, suggestion)
+        log.info("Stored hook function %s for user %s", hook['id'], user_id)
+        
+        # Send confirmation with hook details
+        confirmation = {
+            "type": "suggestion_accepted",
+            "data": {
+                "message": "Automation rule created!",
+                "hook_id": hook['id'],
+                "description": hook['description'],
+                "trigger_event": hook['trigger_event']
+            }
+        }
+        
+        if connection_key in manager.active_connections:
+            await manager.send_message(connection_key, confirmation)
+
+async def _handle_email_event(user_id: str, session_id: str, connection_key: str, event_data: Dict[str, Any]) -> None:
+    """Handle email events that might trigger workflows"""
+    trigger_event = event_data.get("event_type", "email_received")
+    email_data = event_data.get("email", {})
+    context_data = event_data.get("context", {})
+    
+    # Execute any matching workflow hooks
+    executed_workflows = await execute_workflow_hooks(
+        user_id, trigger_event, email_data, context_data
+    )
+    
+    if executed_workflows:
+        log.info("Executed %d workflows for user %s", len(executed_workflows), user_id)
+
+_MESSAGE_HANDLERS = {
+    "suggestion_response": _handle_suggestion_response,
+    "email_event": _handle_email_event,
+}
+
 # WebSocket Endpoint
 @router.websocket("/ws/{user_id}/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str, session_id: str):
     await manager.connect(websocket, user_id, session_id)
+    connection_key = f"{user_id}:{session_id}"
     
     try:
         while True:
-            # Receive message from frontend
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            if message["type"] == "user_action":
-                # Process user action
-                action_data = message["data"]
-                action_data["user_id"] = user_id
-                action_data["session_id"] = session_id
-                action_data["timestamp"] = datetime.now()
-                
-                action = UserAction(**action_data)
-                action_id = store_user_action(action)
-                
-                print(f"Stored action {action_id}: {action.action} on email from {action.email.get('sender')}")
-                
-                # Check if we should analyze for patterns with debouncing
-                if should_analyze_for_patterns(user_id, action):
-                    # Cancel any existing analysis task for this user
-                    if user_id in pending_analysis_tasks:
-                        pending_analysis_tasks[user_id].cancel()
-                        print(f"🚫 Cancelled previous analysis task for user {user_id}")
-                    
-                    # Start new debounced analysis task
-                    print(f"⏱️ Scheduling debounced LLM analysis for user {user_id}...")
-                    task = asyncio.create_task(debounced_analyze_patterns(user_id, action))
-                    pending_analysis_tasks[user_id] = task
-            
-            elif message["type"] == "suggestion_response":
-                # Handle user's response to suggestion
-                response_data = message["data"]
-                suggestion_id = response_data["suggestion_id"]
-                accepted = response_data["accepted"]
-                
-                if accepted and suggestion_id in suggestions_cache:
-                    suggestion = suggestions_cache[suggestion_id]
-                    hook = store_accepted_suggestion(user_id, suggestion)
-                    print(f"Stored hook function {hook['id']} for user {user_id}")
-                    
-                    # Send confirmation with hook details
-                    confirmation = {
-                        "type": "suggestion_accepted",
-                        "data": {
-                            "message": "Automation rule created!",
-                            "hook_id": hook['id'],
-                            "description": hook['description'],
-                            "trigger_event": hook['trigger_event']
-                        }
-                    }
-                    
-                    connection_key = f"{user_id}:{session_id}"
-                    if connection_key in manager.active_connections:
-                        await manager.active_connections[connection_key].send_text(
-                            json.dumps(confirmation)
-                        )
-                
-                # Clean up suggestion from cache
-                if suggestion_id in suggestions_cache:
-                    del suggestions_cache[suggestion_id]
+            # Receive message from frontend: msgpack in binary frames, JSON in text frames
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if frame.get("bytes") is not None and msgpack is not None:
+                message = _json_safe(msgpack.unpackb(frame["bytes"], raw=False, strict_map_key=False))
+            else:
+                message = orjson.loads(frame.get("text") or frame["bytes"])
             
-            elif message["type"] == "email_event":
-                # Handle email events that might trigger workflows
-                event_data = message["data"]
-                trigger_event = event_data.get("event_type", "email_received")
-                email_data = event_data.get("email", {})
-                context_data = event_data.get("context", {})
-                
-                # Execute any matching workflow hooks
-                executed_workflows = await execute_workflow_hooks(
-                    user_id, trigger_event, email_data, context_data
-                )
-                
-                if executed_workflows:
-                    print(f"Executed {len(executed_workflows)} workflows for user {user_id}")
+            message_type = message["type"]
+            if message_type == "user_action":
+                # Fast path: no handler lookup or coroutine for the common case
+                _handle_user_action(user_id, session_id, connection_key, message["data"])
+            else:
+                handler = _MESSAGE_HANDLERS.get(message_type)
+                if handler is not None:
+                    await handler(user_id, session_id, connection_key, message["data"])
     
     except WebSocketDisconnect:
         manager.disconnect(user_id, session_id)
-        print(f"User {user_id} session {session_id} disconnected")
     except Exception as e:
-        print(f"WebSocket error: {e}")
+        log.warning("WebSocket error: %s", e)
         manager.disconnect(user_id, session_id)
 
 # REST Endpoints for debugging/management
 @router.get("/actions/{user_id}")
 async def get_actions(user_id: str):
     """Get user's action history"""
+    # Stored actions are plain dicts orjson handles natively (datetime, str enums),
+    # so skip FastAPI's per-field jsonable_encoder walk
     actions = get_user_actions(user_id, limit=50)
-    return {"actions": [action.dict() for action in actions]}
+    return ORJSONResponse({"actions": actions})
 
 @router.get("/hooks/{user_id}")
 async def get_hooks(user_id: str):
     """Get user's hook functions"""
-    return {"hooks": hook_functions.get(user_id, [])}
+    # Leave out cached code objects ('_code', '_func'), which aren't JSON serializable
+    hooks = [
+        {key: value for key, value in hook.items() if not key.startswith('_')}
+        for hook in hook_functions.get(user_id, [])
+    ]
+    return {"hooks": hooks}
 
 @router.post("/hooks/{user_id}/{hook_id}/toggle")
 async def toggle_hook(user_id: str, hook_id: str):
@@ -746,6 +1144,7 @@ async def toggle_hook(user_id: str, hook_id: str):
     for hook in hook_functions[user_id]:
         if hook['id'] == hook_id:
             hook['enabled'] = not hook.get('enabled', True)
+            reindex_hooks(user_id, hook.get('trigger_event', 'email_received'))
             return {
                 "success": True,
                 "hook_id": hook_id,
@@ -757,29 +1156,91 @@ async def toggle_hook(user_id: str, hook_id: str):
 @router.delete("/hooks/{user_id}/{hook_id}")
 async def delete_hook(user_id: str, hook_id: str):
     """Delete a specific hook"""
+    global _total_hooks, _total_executions
     if user_id not in hook_functions:
         return {"error": "User not found"}
     
-    hook_functions[user_id] = [
-        hook for hook in hook_functions[user_id]
-        if hook['id'] != hook_id
-    ]
+    remaining = []
+    for hook in hook_functions[user_id]:
+        if hook['id'] == hook_id:
+            # Flagged so a run still in flight doesn't count toward _total_executions
+            hook['_deleted'] = True
+            _total_hooks -= 1
+            _total_executions -= hook.get('execution_count', 0)
+        else:
+            remaining.append(hook)
+    hook_functions[user_id] = remaining
+    for trigger_event, hooks in list(hooks_by_trigger.get(user_id, {}).items()):
+        if any(hook['id'] == hook_id for hook in hooks):
+            reindex_hooks(user_id, trigger_event)
     
     return {"success": True, "deleted_hook_id": hook_id}
 
+_STATS_FIELDS = ("total_users", "total_actions", "total_hooks", "total_executions", "active_connections", "suggestions_pending")
+
+@lru_cache(maxsize=2)
+def _encode_stats(snapshot: Tuple[int, ...]) -> Tuple[bytes, str]:
+    """Encode stats and their ETag once per distinct set of counts; repeated polls between changes reuse them"""
+    body = orjson.dumps(dict(zip(_STATS_FIELDS, snapshot)))
+    return body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
 @router.get("/stats")
-async def get_stats():
-    """Get system stats"""
-    total_executions = sum(
-        sum(hook.get('execution_count', 0) for hook in hooks)
-        for hooks in hook_functions.values()
+async def get_stats(request: Request):
+    """Get system stats; pollers sending If-None-Match get a bodiless 304 until something changes"""
+    snapshot = (
+        len(action_logs),
+        _total_actions,
+        _total_hooks,
+        _total_executions,
+        len(manager.active_connections),
+        len(suggestions_cache)
     )
+    body, etag = _encode_stats(snapshot)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+# Batch endpoint: in-process dispatch to the email endpoints, one round trip for a whole sequence
+# Handlers may be route coroutines or plain functions returning the result directly
+_BATCH_OPS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "generate-email": llm_api.generate_email,
+    "store-generated-email": llm_api.store_generated_email_endpoint,
+    "analyze-email-diff": llm_api.analyze_email_diff_endpoint,
+    "user-preferences": lambda payload: llm_api.get_user_preferences_endpoint(payload.get("recipient", "")),
+    "email-diffs": lambda payload: llm_api._email_diffs_page(payload.get("cursor"), int(payload.get("limit", 100))),
+}
+
+@router.post("/batch")
+async def run_batch(request: dict = Body(...)):
+    """Run {"op", "payload"} entries in order, returning one result per entry"""
+    ops = request.get("ops", [])
+    if not isinstance(ops, list):
+        return {"error": "ops must be a list"}
     
-    return {
-        "total_users": len(action_logs),
-        "total_actions": sum(len(actions) for actions in action_logs.values()),
-        "total_hooks": sum(len(hooks) for hooks in hook_functions.values()),
-        "total_executions": total_executions,
-        "active_connections": len(manager.active_connections),
-        "suggestions_pending": len(suggestions_cache)
-    }
+    results = []
+    # Sequential on purpose: later ops (e.g. analyze-email-diff) may depend on earlier ones.
+    # Handlers are called directly, without FastAPI validation, so a bad entry only fails its
+    # own result slot instead of failing the batch after earlier ops have applied.
+    for entry in ops:
+        if not isinstance(entry, dict):
+            results.append({"error": "Batch entries must be objects with 'op' and 'payload'"})
+            continue
+        op = entry.get("op")
+        handler = _BATCH_OPS.get(op)
+        if handler is None:
+            results.append({"error": f"Unknown op: {op}"})
+            continue
+        payload = entry.get("payload") or {}
+        if not isinstance(payload, dict):
+            results.append({"error": "payload must be an object"})
+            continue
+        try:
+            result = handler(payload)
+            if inspect.isawaitable(result):
+                result = await result
+            results.append(result)
+        except Exception as e:
+            log.warning("Batch op %s failed: %s", op, e)
+            results.append({"error": f"{op} failed: {e}"})
+    
+    return {"results": results}
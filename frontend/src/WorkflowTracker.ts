@@ -65,7 +65,7 @@ export class WorkflowTracker {
 
   private connect() {
     try {
-      this.ws = new WebSocket(`ws://localhost:8000/ws/${this.userId}/${this.sessionId}`);
+      this.ws = new WebSocket(`ws://localhost:8000/api/workflow/ws/${this.userId}/${this.sessionId}`);
 
       this.ws.onopen = () => {
         console.log("WorkflowTracker connected");
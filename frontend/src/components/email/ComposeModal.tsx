@@ -51,6 +51,11 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
     body: string;
   } | null>(null);
   const [generatedEmailId, setGeneratedEmailId] = useState<string>("");
+  // Original generated copy, kept only when the server failed to store it
+  const [unstoredGeneratedContent, setUnstoredGeneratedContent] = useState<{
+    subject: string;
+    body: string;
+  } | null>(null);
 
   const handleSend = async () => {
     // Send the email
@@ -65,18 +70,9 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
     // If this was an AI-generated email, analyze the diffs for learning
     if (generatedContent && generatedEmailId) {
       try {
-        // First, get the stored original generated content
-        const storedResponse = await fetch(
-          `${import.meta.env.VITE_API_HOST}/api/stored-email/${generatedEmailId}`
-        );
-        let originalGeneratedContent = generatedContent; // fallback to current state
-
-        if (storedResponse.ok) {
-          const storedData = await storedResponse.json();
-          originalGeneratedContent = storedData.generated_content;
-        }
-
-        await fetch(`${import.meta.env.VITE_API_HOST}/api/analyze-email-diff`, {
+        // The server diffs against its stored copy of the generated email;
+        // the original is only sent along if storing it failed
+        const diffResponse = await fetch(`${import.meta.env.VITE_API_HOST}/api/analyze-email-diff`, {
           method: "POST",
           headers: {
             "Content-Type": "application/json",
@@ -84,7 +80,9 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
           body: JSON.stringify({
             email_id: generatedEmailId,
             recipient: to || "team",
-            generated_content: originalGeneratedContent,
+            ...(unstoredGeneratedContent && {
+              generated_content: unstoredGeneratedContent,
+            }),
             final_content: {
               subject: generatedContent ? generatedContent.subject : subject,
               body: generatedContent ? generatedContent.body : body,
@@ -92,12 +90,21 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
           }),
         });
 
-        toastManager.add({
-          title: "Preferences learned!",
-          description:
-            "Your email preferences have been saved for future AI generations.",
-          type: "success",
-        });
+        if (diffResponse.ok) {
+          toastManager.add({
+            title: "Preferences learned!",
+            description:
+              "Your email preferences have been saved for future AI generations.",
+            type: "success",
+          });
+        } else {
+          console.error(
+            "Failed to analyze email diff. Status:",
+            diffResponse.status,
+            "Response:",
+            await diffResponse.text()
+          );
+        }
       } catch (error) {
         console.error("Failed to analyze email diff:", error);
         // Continue even if analysis fails
@@ -171,8 +178,12 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
         setGeneratedEmailId(emailId);
 
         // Store the generated email for later diff analysis
+        setUnstoredGeneratedContent({
+          subject: generatedSubject,
+          body: generatedBody,
+        });
         try {
-          await fetch(`${import.meta.env.VITE_API_HOST}/api/store-generated-email`, {
+          const storeResponse = await fetch(`${import.meta.env.VITE_API_HOST}/api/store-generated-email`, {
             method: "POST",
             headers: {
               "Content-Type": "application/json",
@@ -186,6 +197,9 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
               },
             }),
           });
+          if (storeResponse.ok) {
+            setUnstoredGeneratedContent(null);
+          }
         } catch (error) {
           console.error("Failed to store generated email:", error);
           // Continue even if storage fails
@@ -248,6 +262,7 @@ export const ComposeModal = ({ isOpen, onClose }: ComposeModalProps) => {
     setTone("friendly");
     setGeneratedContent(null);
     setGeneratedEmailId("");
+    setUnstoredGeneratedContent(null);
     setShowCcBcc(false);
   };
 